@@ -12,21 +12,33 @@ from .worker import InsightWorker
 
 logging.basicConfig(level=logging.INFO)
 
-postgres_uri = env.get("POSTGRES_URI")
-if not postgres_uri:
-    logging.error("Missing required environment variable: POSTGRES_URI")
-    raise ValueError("POSTGRES_URI environment variable is required")
-
-connect_args = {"options": "-csearch_path=private,public"}
-engine = create_engine(postgres_uri, connect_args=connect_args)
-
-# Create global service instances
-opensearch_service = OpenSearchService()
-minio_service = MinioService()
-pdf_service = PdfService()
-
-# Create worker instance
-worker = InsightWorker(engine, opensearch_service, minio_service, pdf_service)
+# Services are created by the commands that need them rather than on import.
+# OCR and extraction worker processes are started from a forkserver, which
+# imports the main module again, they shouldn't build their own pools,
+# database engine and clients
+def create_worker():
+    postgres_uri = env.get("POSTGRES_URI")
+    if not postgres_uri:
+        logging.error("Missing required environment variable: POSTGRES_URI")
+        raise ValueError("POSTGRES_URI environment variable is required")
+
+    connect_args = {"options": "-csearch_path=private,public"}
+    engine = create_engine(
+        postgres_uri,
+        connect_args=connect_args,
+        # Bulk statements are sent in pages of up to 1000 rows
+        insertmanyvalues_page_size=1000,
+        executemany_mode="values_plus_batch",
+        # Connections are kept for the lifetime of the worker. They are checked
+        # before use and replaced periodically, so long idle periods between
+        # messages don't surface as errors on the next message
+        pool_size=int(env.get("POSTGRES_POOL_SIZE", 10)),
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=300,
+    )
+
+    return InsightWorker(engine, OpenSearchService(), MinioService(), PdfService())
 
 
 @click.group()
@@ -38,7 +50,7 @@ def cli():
 def create_index():
     logging.info("Creating index")
     try:
-        opensearch_service.configure_index()
+        OpenSearchService().configure_index()
         logging.info("Index created successfully")
     except Exception as e:
         raise Exception(f"Failed to create index: {str(e)}")
@@ -47,7 +59,7 @@ def create_index():
 @cli.command()
 def delete_index():
     try:
-        opensearch_service.delete_index()
+        OpenSearchService().delete_index()
         logging.info("Index destroyed successfully")
     except Exception as e:
         raise Exception(f"Failed to delete index: {str(e)}")
@@ -55,6 +67,9 @@ def delete_index():
 
 @cli.command()
 def rebuild_index():
+    worker = create_worker()
+    opensearch_service = worker.opensearch_service
+
     try:
         opensearch_service.delete_index()
         logging.info("Index destroyed successfully")
@@ -67,7 +82,7 @@ def rebuild_index():
     except Exception as e:
         raise Exception(f"Failed to create index: {str(e)}")
 
-    with Session(engine) as session:
+    with Session(worker.engine) as session:
         stmt = update(Inodes).values(is_indexed=False)
         session.execute(stmt)
         session.commit()
@@ -85,6 +100,9 @@ def rebuild_index():
 
 @cli.command()
 def process_messages():
+    worker = create_worker()
+    opensearch_service = worker.opensearch_service
+
     # Configure index
     # This is here so we can just clear the dev environment and everything will still work
     opensearch_service.configure_index()
@@ -103,6 +121,7 @@ def process_messages():
         except (KeyboardInterrupt, SystemExit):
             # Close the connection on exit
             await worker.connection.close()
+            opensearch_service.close()
 
     # Run the async main function
     asyncio.run(main())
@@ -1,10 +1,40 @@
+import os
 import re
+import shutil
+import certifi
+import urllib3
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from minio import Minio
 from minio.commonconfig import CopySource, Tags
 from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
 from os import environ as env
+from pathlib import Path
+from threading import Lock
 from urllib.parse import urlparse
-from typing import Optional, List, Iterable, Dict, Any
+from urllib3.util.retry import Retry
+from typing import Optional, List, Iterable, Dict, Any, BinaryIO
+
+# Inserts "_optimized" before the extension of the file name
+OPTIMIZED_PATH_PATTERN = re.compile(r"(.+)(/[^/.]+)(\..+)$")
+
+# Read buffer used when streaming objects to disk
+DOWNLOAD_BUFFER_SIZE = 8 * 1024 * 1024
+# Objects larger than this are downloaded in concurrent ranged requests
+RANGED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+RANGED_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+# Part size of multipart uploads, and the amount of parts uploaded at once
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+UPLOAD_PARALLEL_PARTS = 8
+# Metadata on optimized objects, referring to the original they were made from
+SOURCE_ETAG_HEADER = "x-amz-meta-source-etag"
+# Keep-alive connections to storage, enough for every thread in the executor
+# plus requests made from the worker itself
+HTTP_POOL_SIZE = 32
+# Connect and read timeout of storage requests, the minio default
+HTTP_TIMEOUT = 300
+# Default size limit of the local cache of downloaded originals
+CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
 
 
 class MinioService:
@@ -18,6 +48,8 @@ class MinioService:
         bucket: Optional[str] = None,
         region: Optional[str] = None,
         secure: Optional[bool] = None,
+        cache_dir: Optional[str] = None,
+        cache_max_size: Optional[int] = None,
     ):
         self.endpoint_url = endpoint or env.get("STORAGE_ENDPOINT")
         self.access_key = access_key or env.get("STORAGE_ACCESS_KEY")
@@ -33,7 +65,34 @@ class MinioService:
             access_key=self.access_key,
             secret_key=self.secret_key,
             region=self.region,
+            # Same settings as the client minio creates by default, only with a
+            # larger pool
+            http_client=urllib3.PoolManager(
+                maxsize=HTTP_POOL_SIZE,
+                timeout=urllib3.Timeout(connect=HTTP_TIMEOUT, read=HTTP_TIMEOUT),
+                cert_reqs="CERT_REQUIRED",
+                ca_certs=env.get("SSL_CERT_FILE") or certifi.where(),
+                retries=Retry(
+                    total=5,
+                    backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504],
+                ),
+            ),
         )
+        # Threads for concurrent requests within a single operation
+        self.executor = ThreadPoolExecutor(max_workers=8)
+
+        # Originals are cached on disk by ETag when a cache directory is set,
+        # so re-ingesting an unchanged file does not download it again
+        cache_dir = cache_dir or env.get("STORAGE_CACHE_DIR")
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.cache_max_size = cache_max_size or int(
+            env.get("STORAGE_CACHE_MAX_SIZE", CACHE_MAX_SIZE)
+        )
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_lock = Lock()
+        self.cache_downloads: Dict[Path, Future] = {}
 
     def object_path(self, owner_id: str, path: str) -> str:
         """Generate the object path for a file
@@ -57,22 +116,225 @@ class MinioService:
         Returns:
             Full object path for the optimized version
         """
-        optimized_path = re.sub(r"(.+)(/[^/.]+)(\..+)$", r"\1\2_optimized\3", path)
+        # Common case, a file name with an extension that isn't in the root folder
+        slash = path.rfind("/")
+        dot = path.find(".", slash + 1)
+        if slash >= 1 and slash + 1 < dot < len(path) - 1 and "\n" not in path:
+            return f"users/{owner_id}{path[:dot]}_optimized{path[dot:]}"
+
+        optimized_path = OPTIMIZED_PATH_PATTERN.sub(r"\1\2_optimized\3", path)
         return f"users/{owner_id}{optimized_path}"
 
-    def download_file(self, owner_id: str, path: str, target_path: str) -> None:
+    def _download_range(
+        self, object_path: str, fd: int, offset: int = 0, length: int = 0
+    ) -> None:
+        """Stream (a range of) an object into an open file descriptor
+
+        Args:
+            object_path: Full object path in storage
+            fd: File descriptor to write to
+            offset: Start of the range, both in the object and the file
+            length: Length of the range, 0 reads until the end of the object
+        """
+        response = self.client.get_object(
+            self.bucket, object_path, offset=offset, length=length
+        )
+        try:
+            while data := response.read(DOWNLOAD_BUFFER_SIZE):
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def get_etag(self, owner_id: str, path: str) -> str:
+        """Get the ETag of a file
+
+        Args:
+            owner_id: User ID that owns the file
+            path: Path to the file
+
+        Returns:
+            ETag of the original object
+        """
+        return self.client.stat_object(
+            self.bucket, self.object_path(owner_id, path)
+        ).etag
+
+    def get_optimized_source_etag(self, owner_id: str, path: str) -> Optional[str]:
+        """Get the ETag of the original the optimized version was made from
+
+        Args:
+            owner_id: User ID that owns the file
+            path: Path to the file
+
+        Returns:
+            ETag stored on the optimized object, None if there is no optimized
+            object or it was uploaded without one
+        """
+        try:
+            stat = self.client.stat_object(
+                self.bucket, self.optimized_object_path(owner_id, path)
+            )
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return None
+            raise
+        return stat.metadata.get(SOURCE_ETAG_HEADER)
+
+    def download_file(
+        self,
+        owner_id: str,
+        path: str,
+        target_path: str,
+        etag: Optional[str] = None,
+    ) -> None:
         """Download a file from object storage
 
+        When a cache directory is configured and the ETag is known, the file
+        is served from the local cache if present, and added to it otherwise.
+
         Args:
             owner_id: User ID that owns the file
             path: Path to the file
             target_path: Local filesystem path to download to
+            etag: ETag of the original, used as cache key
         """
-        self.client.fget_object(
-            self.bucket,
-            self.object_path(owner_id, path),
-            target_path,
-        )
+        if self.cache_dir is None or not etag:
+            self._download_object(self.object_path(owner_id, path), target_path)
+            return
+
+        cache_path = self.cache_dir / etag.strip('"')
+        if self._copy_from_cache(cache_path, target_path):
+            return
+
+        # Concurrent downloads of the same original wait for the first one to
+        # fill the cache instead of fetching it again
+        with self.cache_lock:
+            download = self.cache_downloads.get(cache_path)
+            is_leader = download is None
+            if is_leader:
+                download = self.cache_downloads[cache_path] = Future()
+
+        if not is_leader:
+            download.result()
+            if self._copy_from_cache(cache_path, target_path):
+                return
+            # Evicted already, or could not be cached
+            self._download_object(self.object_path(owner_id, path), target_path)
+            return
+
+        try:
+            self._download_object(self.object_path(owner_id, path), target_path)
+            self._add_to_cache(target_path, cache_path)
+            download.set_result(None)
+        except BaseException as e:
+            download.set_exception(e)
+            raise
+        finally:
+            with self.cache_lock:
+                del self.cache_downloads[cache_path]
+
+    def _copy_from_cache(self, cache_path: Path, target_path: str) -> bool:
+        """Link a cached file into place
+
+        Args:
+            cache_path: Location of the file in the cache
+            target_path: Local filesystem path to link to
+
+        Returns:
+            True if the file was in the cache
+        """
+        try:
+            # Mark as recently used for eviction
+            os.utime(cache_path)
+            self._link_or_copy(cache_path, target_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _link_or_copy(self, source_path, target_path) -> None:
+        """Hard link a file, copying it when on a different filesystem"""
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copyfile(source_path, target_path)
+
+    def _add_to_cache(self, file_path: str, cache_path: Path) -> None:
+        """Add a downloaded file to the cache and evict least recently used
+
+        Args:
+            file_path: Local file to store in the cache
+            cache_path: Location of the file in the cache
+        """
+        # Stage next to the cache entry so the rename is atomic
+        staging_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}")
+        try:
+            self._link_or_copy(file_path, staging_path)
+            os.replace(staging_path, cache_path)
+        except OSError:
+            staging_path.unlink(missing_ok=True)
+            return
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.cache_max_size:
+                break
+            try:
+                os.unlink(entry_path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def download_optimized_file(
+        self, owner_id: str, path: str, target_path: str
+    ) -> None:
+        """Download the optimized version of a file from object storage
+
+        Args:
+            owner_id: User ID that owns the file
+            path: Path to the file
+            target_path: Local filesystem path to download to
+        """
+        self._download_object(self.optimized_object_path(owner_id, path), target_path)
+
+    def _download_object(self, object_path: str, target_path: str) -> None:
+        """Download an object to a local file
+
+        Large objects are fetched as concurrent ranged requests.
+
+        Args:
+            object_path: Full object path in storage
+            target_path: Local filesystem path to download to
+        """
+        size = self.client.stat_object(self.bucket, object_path).size
+
+        with open(target_path, "wb") as file:
+            if size <= RANGED_DOWNLOAD_THRESHOLD:
+                self._download_range(object_path, file.fileno())
+                return
+
+            file.truncate(size)
+            futures = [
+                self.executor.submit(
+                    self._download_range,
+                    object_path,
+                    file.fileno(),
+                    offset,
+                    min(RANGED_DOWNLOAD_PART_SIZE, size - offset),
+                )
+                for offset in range(0, size, RANGED_DOWNLOAD_PART_SIZE)
+            ]
+            # All parts have to finish before the file is closed
+            wait(futures)
+            for future in futures:
+                future.result()
 
     def upload_file(self, owner_id: str, path: str, source_path: str) -> None:
         """Upload a file to object storage
@@ -88,18 +350,51 @@ class MinioService:
             source_path,
         )
 
-    def upload_optimized_file(self, owner_id: str, path: str, source_path: str) -> None:
+    def upload_optimized_file(
+        self,
+        owner_id: str,
+        path: str,
+        source_path: str,
+        source_etag: Optional[str] = None,
+    ) -> None:
         """Upload an optimized file to object storage
 
         Args:
             owner_id: User ID that owns the file
             path: Path to store the file
             source_path: Local filesystem path to upload from
+            source_etag: ETag of the original the file was made from
         """
-        self.client.fput_object(
+        with open(source_path, "rb") as file:
+            length = os.fstat(file.fileno()).st_size
+            self.upload_optimized_data(owner_id, path, file, length, source_etag)
+
+    def upload_optimized_data(
+        self,
+        owner_id: str,
+        path: str,
+        data: BinaryIO,
+        length: int,
+        source_etag: Optional[str] = None,
+    ) -> None:
+        """Upload an optimized file to object storage from a stream
+
+        Args:
+            owner_id: User ID that owns the file
+            path: Path to store the file
+            data: Stream to upload from
+            length: Amount of bytes to upload
+            source_etag: ETag of the original the file was made from
+        """
+        self.client.put_object(
             self.bucket,
             self.optimized_object_path(owner_id, path),
-            source_path,
+            data,
+            length,
+            content_type="application/pdf",
+            metadata={"source-etag": source_etag} if source_etag else None,
+            part_size=UPLOAD_PART_SIZE,
+            num_parallel_uploads=UPLOAD_PARALLEL_PARTS,
         )
 
     def set_public_tags(self, owner_id: str, path: str, is_public: bool) -> None:
@@ -113,12 +408,19 @@ class MinioService:
         tags = Tags.new_object_tags()
         tags["is_public"] = str(is_public)
         
-        # Apply tags to both original and optimized files
-        for object_path in [
-            self.object_path(owner_id, path),
-            self.optimized_object_path(owner_id, path),
-        ]:
-            self.client.set_object_tags(self.bucket, object_path, tags)
+        # Apply tags to both original and optimized files concurrently
+        futures = [
+            self.executor.submit(
+                self.client.set_object_tags, self.bucket, object_path, tags
+            )
+            for object_path in [
+                self.object_path(owner_id, path),
+                self.optimized_object_path(owner_id, path),
+            ]
+        ]
+        wait(futures)
+        for future in futures:
+            future.result()
 
     def move_file(self, owner_id: str, old_path: str, new_path: str) -> None:
         """Move a file in object storage
@@ -139,13 +441,33 @@ class MinioService:
             ),
         ]
 
-        for old, new in paths:
-            self.client.copy_object(
+        # Server side copies are independent, run them concurrently
+        futures = [
+            self.executor.submit(
+                self.client.copy_object,
                 self.bucket,
                 new,
                 CopySource(self.bucket, old),
             )
-            self.client.remove_object(self.bucket, old)
+            for old, new in paths
+        ]
+        moved = []
+        for (old, _), future in zip(paths, futures):
+            try:
+                future.result()
+            except S3Error as e:
+                # Files that failed ingest have no optimized version, that
+                # shouldn't keep the original from moving
+                if e.code != "NoSuchKey" or old == paths[0][0]:
+                    raise
+                continue
+            moved.append(old)
+
+        # Remove the old objects in a single request
+        delete_objects = (DeleteObject(old) for old in moved)
+        errors = list(self.client.remove_objects(self.bucket, delete_objects))
+        if errors:
+            raise Exception(f"Could not remove moved objects: {errors}")
 
     def delete_file(self, owner_id: str, path: str) -> List[Dict[str, Any]]:
         """Delete a file from object storage
@@ -157,11 +479,28 @@ class MinioService:
         Returns:
             List of any errors that occurred during deletion
         """
-        paths = [
-            self.object_path(owner_id, path),
-            self.optimized_object_path(owner_id, path),
-        ]
-        delete_objects = (DeleteObject(path) for path in paths)
+        return self.delete_files(owner_id, [path])
+
+    def delete_files(
+        self, owner_id: str, paths: Iterable[str]
+    ) -> List[Dict[str, Any]]:
+        """Delete files and their optimized versions in a single batch request
+
+        Args:
+            owner_id: User ID that owns the files
+            paths: Paths to the files
+
+        Returns:
+            List of any errors that occurred during deletion
+        """
+        delete_objects = (
+            DeleteObject(object_path)
+            for path in paths
+            for object_path in (
+                self.object_path(owner_id, path),
+                self.optimized_object_path(owner_id, path),
+            )
+        )
         
         errors = list(self.client.remove_objects(self.bucket, delete_objects))
         return errors
\ No newline at end of file
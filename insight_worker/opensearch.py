@@ -1,9 +1,19 @@
 import logging
+import time
 import httpx
+import orjson
 from base64 import b64encode
 from os import environ as env
 from urllib.parse import urlparse
-from typing import Dict, Optional, Any, Union
+from typing import Dict, Iterable, List, Optional, Any, Tuple, Union
+
+# Amount of documents sent in a single bulk request
+BULK_CHUNK_SIZE = 500
+# Size limit of a single bulk request
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+# Retries of documents rejected with 429, backing off exponentially
+BULK_RETRIES = 3
+BULK_RETRY_BACKOFF = 0.5
 
 
 class OpenSearchService:
@@ -22,21 +32,54 @@ class OpenSearchService:
         self.ca_cert = ca_cert if ca_cert is not None else env.get("OPENSEARCH_CA_CERT")
         self.url = urlparse(self.endpoint)
         self.token = b64encode(f"{self.user}:{self.password}".encode())
+        # Keep connections alive between requests, concurrent messages share them
+        self.client = httpx.Client(
+            headers={"Authorization": f"Basic {self.token.decode()}"},
+            verify=self.ca_cert if self.url.scheme == "https" else None,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+            # Bulk requests of up to BULK_MAX_CHUNK_BYTES can take a while to be
+            # processed on a busy cluster, well beyond the default of 5 seconds
+            timeout=httpx.Timeout(
+                10, read=float(env.get("OPENSEARCH_READ_TIMEOUT", 120))
+            ),
+        )
+
+    def close(self):
+        """Close the pooled connections to OpenSearch"""
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-    def _request(self, method: str, path: str, json: Optional[Dict[str, Any]] = None):
+    def _request(
+        self,
+        method: str,
+        path: str,
+        json: Optional[Dict[str, Any]] = None,
+        content: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ):
         """Create a http request to OpenSearch with authentication
 
         :param method: GET, POST, PUT, DELETE
         :param path: the path to request
         :param json: json data to send
+        :param content: raw body to send instead of json
+        :param headers: additional request headers
         :return: a `Response` object
         """
-        return httpx.request(
+        if json is not None:
+            content = orjson.dumps(json)
+            headers = {"Content-Type": "application/json", **(headers or {})}
+
+        return self.client.request(
             method,
             f"{self.endpoint}{path}",
-            headers={"Authorization": f"Basic {self.token.decode()}"},
-            verify=self.ca_cert if self.url.scheme == "https" else None,
-            json=json,
+            headers=headers,
+            content=content,
         )
 
     def configure_index(self):
@@ -79,7 +122,16 @@ class OpenSearchService:
                             "name": "hnsw",
                             "space_type": "l2",
                             "engine": "faiss",
-                            "parameters": {"ef_construction": 400, "m": 16},
+                            "parameters": {
+                                "ef_construction": 400,
+                                "m": 16,
+                                # Store vectors as 16 bit floats, halving the
+                                # size of the graph with negligible recall loss
+                                "encoder": {
+                                    "name": "sq",
+                                    "parameters": {"type": "fp16"},
+                                },
+                            },
                         },
                     },
                 }
@@ -124,6 +176,91 @@ class OpenSearchService:
             raise Exception(res.text)
         return res
 
+    def bulk_index(
+        self,
+        documents: Iterable[Tuple[str, Dict[str, Any], Optional[str]]],
+        chunk_size: int = BULK_CHUNK_SIZE,
+        max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+    ):
+        """Index documents in OpenSearch through the bulk API
+
+        Documents are sent in chunks bounded by count and size, so large files
+        don't end up in a single request.
+
+        :param documents: Iterable of (document ID, document data, routing key)
+        :param chunk_size: Amount of documents per bulk request
+        :param max_chunk_bytes: Maximum size of a bulk request body
+        """
+        chunk = []
+        chunk_bytes = 0
+        for id, document, routing_key in documents:
+            action = {"_id": id}
+            if routing_key is not None:
+                action["routing"] = str(routing_key)
+            # orjson writes numpy arrays like embeddings without converting them
+            # to lists of Python floats first
+            entry = b"%s\n%s\n" % (
+                orjson.dumps({"index": action}),
+                orjson.dumps(document, option=orjson.OPT_SERIALIZE_NUMPY),
+            )
+
+            if chunk and (
+                len(chunk) >= chunk_size or chunk_bytes + len(entry) > max_chunk_bytes
+            ):
+                self._send_bulk(chunk)
+                chunk = []
+                chunk_bytes = 0
+
+            chunk.append(entry)
+            chunk_bytes += len(entry)
+
+        if chunk:
+            self._send_bulk(chunk)
+
+    def _send_bulk(self, chunk: List[bytes]):
+        """Send a bulk request, retrying documents rejected for back pressure
+
+        :param chunk: NDJSON encoded action and document pairs
+        """
+        for attempt in range(BULK_RETRIES + 1):
+            if attempt:
+                time.sleep(BULK_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            res = self._request(
+                "post",
+                # Only per document status and errors are used, leave out the
+                # rest of the item metadata OpenSearch returns
+                "/inodes/_bulk?filter_path=errors,items.*.status,items.*.error",
+                content=b"".join(chunk),
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+            # The whole request was rejected, send it again
+            if res.status_code == 429:
+                continue
+            if res.status_code != 200:
+                raise Exception(res.text)
+
+            result = orjson.loads(res.content)
+            if not result["errors"]:
+                return
+
+            # Retry documents that were rejected because OpenSearch is busy, any
+            # other failure is final
+            retry = []
+            failed = []
+            for entry, item in zip(chunk, result["items"]):
+                if item["index"]["status"] == 429:
+                    retry.append(entry)
+                elif "error" in item["index"]:
+                    failed.append(item["index"])
+            if failed:
+                raise Exception(f"Failed to index documents: {failed}")
+            if not retry:
+                return
+            chunk = retry
+
+        raise Exception("Failed to index documents: too many requests")
+
     def delete_document(self, id: str):
         """Delete a document from OpenSearch
 
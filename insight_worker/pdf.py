@@ -1,26 +1,164 @@
 import ocrmypdf
 import magic
+import pymupdf
+import os
 import subprocess
-from multiprocessing import Process
-from pikepdf import Pdf
-from pdfminer.high_level import extract_pages
-from pdfminer.layout import LTTextContainer
-from typing import List
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from os import environ as env
+from pikepdf import Pdf, PdfError
+from threading import Lock
+from typing import List, Optional, Sequence, Tuple
+
+# Below this amount of pages, text extraction is not worth distributing
+PARALLEL_EXTRACT_MIN_PAGES = 8
+
+# Every PDF file starts with this, followed by the version
+PDF_HEADER = b"%PDF-"
+
+
+def _init_ocr_worker() -> None:
+    """Limit Tesseract to a single thread when an OCR worker process starts
+
+    Sets OMP_THREAD_LIMIT, unless configured otherwise. Pages are processed in
+    parallel by OCRmyPDF instead, which scales better than Tesseract's OpenMP
+    threads.
+    """
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def _extract_pages_text(
+    path: str, page_numbers: Sequence[int], sort: bool = False
+) -> List[str]:
+    """Extract text from the given pages of a PDF file
+
+    Documents can't be shared between processes, so every call opens its own.
+
+    Args:
+        path: Path to the PDF file
+        page_numbers: Zero-based indexes of the pages to extract
+        sort: Reconstruct reading order of the text blocks, which is slow
+
+    Returns:
+        List of text content for each requested page
+    """
+    with pymupdf.open(path) as doc:
+        return [doc[index].get_text("text", sort=sort) for index in page_numbers]
 
 
 class PdfService:
     """Service for handling PDF processing operations"""
 
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        ocr_workers: Optional[int] = None,
+        ocr_jobs: Optional[int] = None,
+        extract_workers: Optional[int] = None,
+    ):
+        self.ocr_workers = ocr_workers or int(env.get("OCR_WORKERS", 1))
+        # Pages OCRmyPDF processes in parallel within a single file. Defaults to
+        # half the cores, leaving room for extraction and the other workers. When
+        # running several OCR workers, set this to cores / OCR_WORKERS
+        self.ocr_jobs = ocr_jobs or int(
+            env.get("OCRMYPDF_JOBS", max(1, (os.cpu_count() or 2) // 2))
+        )
+        self.extract_workers = extract_workers or int(
+            env.get("EXTRACT_WORKERS", min(os.cpu_count() or 1, 4))
+        )
+        # Text is indexed and embedded, which doesn't depend on reading order.
+        # Sorting the text blocks of every page is the slowest extraction mode
+        self.sort_text = env.get("PDF_TEXT_SORT", "").lower() == "true"
+        # Load the magic database once instead of on every MIME type check. It
+        # lives on the service, so worker processes importing this module don't
+        # load it too
+        self.magic = magic.Magic(mime=True)
+        # Worker processes are started once and reused for every file
+        self.ocr_pool = self._create_ocr_pool()
+        self.extract_pool = self._create_extract_pool()
+        self.pool_lock = Lock()
+
+    def _create_ocr_pool(self) -> ProcessPoolExecutor:
+        """Create the process pool OCR jobs run in
+
+        Workers are started from a forkserver, so they are forked from a small
+        preloaded interpreter instead of cloning the worker with all its state.
+        """
+        return ProcessPoolExecutor(
+            max_workers=self.ocr_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_ocr_worker,
+        )
+
+    def _create_extract_pool(self) -> ProcessPoolExecutor:
+        """Create the process pool text extraction shards run in
+
+        Like the OCR pool, workers are started from a forkserver. Forking the
+        multi-threaded worker directly can deadlock the child.
+        """
+        return ProcessPoolExecutor(
+            max_workers=self.extract_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+    def _replace_pool(self, name: str, pool: ProcessPoolExecutor) -> None:
+        """Replace a broken process pool
+
+        Concurrent jobs can all see the same broken pool, it is replaced once.
+
+        Args:
+            name: Attribute the pool is stored in, "ocr_pool" or "extract_pool"
+            pool: The pool that broke
+        """
+        with self.pool_lock:
+            if getattr(self, name) is pool:
+                pool.shutdown(wait=False)
+                setattr(self, name, getattr(self, f"_create_{name}")())
+
+    def inspect_pdf(self, path: str) -> Tuple[Optional[int], bool]:
+        """Read the page count and check whether a PDF needs repair in one pass
+
+        Args:
+            path: Path to the PDF file
+
+        Returns:
+            Tuple of the number of pages, None if the file can't be opened, and
+            whether the file needs repair
+        """
+        try:
+            with Pdf.open(path) as pdf:
+                # Encrypted files are rejected by OCRmyPDF, rewriting them drops
+                # the encryption
+                needs_repair = bool(
+                    pdf.is_encrypted or pdf.get_warnings() or pdf.check()
+                )
+                return len(pdf.pages), needs_repair
+        except PdfError:
+            return None, True
 
-    def repair_pdf(self, input_file: str, output_file: str) -> None:
-        """Repair a potentially corrupt PDF file using Ghostscript
+    def repair_pdf(self, input_file: str, output_file: str) -> bool:
+        """Repair a potentially corrupt PDF file
+
+        Files that pikepdf can still open are rewritten by it, which rebuilds the
+        cross-reference table without re-rendering every page. The rewrite is
+        linearized in the same pass, so it can be served as is when it doesn't
+        need OCR. Only files pikepdf can't open at all go through Ghostscript.
 
         Args:
             input_file: Path to the input PDF file
             output_file: Path to write the repaired PDF file
+
+        Returns:
+            True if the repaired file is linearized
         """
+        try:
+            with Pdf.open(input_file) as pdf:
+                pdf.save(output_file, linearize=True)
+            return True
+        except PdfError:
+            pass
+
         subprocess.check_call(
             [
                 "/usr/bin/gs",
@@ -33,13 +171,16 @@ class PdfService:
                 input_file,
             ]
         )
+        return False
 
-    def _ocrmypdf_process(self, input_file: str, output_file: str) -> None:
+    @staticmethod
+    def _ocrmypdf_process(input_file: str, output_file: str, jobs: int) -> None:
         """Internal OCR process that runs OCRmyPDF on a file
 
         Args:
             input_file: Path to the input PDF file
             output_file: Path to write the OCRed PDF file
+            jobs: Amount of pages to process in parallel
         """
         ocrmypdf.ocr(
             input_file,
@@ -51,8 +192,7 @@ class PdfService:
             progress_bar=False,
             # https://github.com/ocrmypdf/OCRmyPDF/issues/1162
             continue_on_soft_render_error=True,
-            # Only use one thread
-            jobs=1,
+            jobs=jobs,
             # Skip pages with text layer on it
             # TODO - Enable user to force OCR
             skip_text=True,
@@ -62,49 +202,123 @@ class PdfService:
             invalidate_digital_signatures=True,
         )
 
+    def _run_ocr_job(self, fn, *args) -> None:
+        """Run a function in the OCR pool and wait for it
+
+        When a worker died, the pool is broken for every later job. It is
+        replaced before the error is raised, so the next job gets a working pool.
+
+        Args:
+            fn: Function to run in a worker process
+            *args: Arguments to the function
+        """
+        pool = self.ocr_pool
+        try:
+            pool.submit(fn, *args).result()
+        except BrokenProcessPool:
+            self._replace_pool("ocr_pool", pool)
+            raise
+
+    def warm_up(self) -> None:
+        """Start an OCR worker process ahead of the first OCR job
+
+        This is best effort, a broken pool is replaced and the OCR job starts a
+        worker in the new one.
+        """
+        try:
+            self._run_ocr_job(_init_ocr_worker)
+        except BrokenProcessPool:
+            pass
+
     def optimize_pdf(self, input_path: str, output_path: str) -> None:
         """OCR and optimize a PDF file
 
-        Runs OCRmyPDF in a separate process to avoid any memory leaks.
+        Runs OCRmyPDF in a pooled worker process to avoid any memory leaks and
+        to contain crashes. When a worker dies the pool is replaced, so the next
+        file gets a working pool again.
 
         Args:
             input_path: Path to the input PDF file
             output_path: Path to write the optimized PDF file
         """
-        process = Process(target=self._ocrmypdf_process, args=(input_path, output_path))
-        process.start()
-        process.join()
+        self._run_ocr_job(
+            self._ocrmypdf_process, input_path, output_path, self.ocr_jobs
+        )
+
+    def linearize_pdf(self, input_path: str) -> BytesIO:
+        """Linearize a PDF file for fast web view without running OCR
+
+        The result is kept in memory, it is only needed for upload.
+
+        Args:
+            input_path: Path to the input PDF file
+
+        Returns:
+            Buffer containing the linearized PDF, positioned at the start
+        """
+        output = BytesIO()
+        with Pdf.open(input_path) as pdf:
+            pdf.save(output, linearize=True)
+        output.seek(0)
+        return output
 
-    def extract_pdf_pages_text(self, path: str) -> List[str]:
-        """Extract text from all pages in a PDF file
+    def extract_pdf_pages_text(
+        self, path: str, page_numbers: Optional[List[int]] = None
+    ) -> List[str]:
+        """Extract text from pages in a PDF file
 
         Args:
             path: Path to the PDF file
+            page_numbers: Zero-based indexes of the pages to extract, all pages
+                when omitted
 
         Returns:
-            List of text content for each page
+            List of text content for each requested page
         """
-        texts = []
-        for page_layout in extract_pages(path):
-            text = ""
-            for element in page_layout:
-                if isinstance(element, LTTextContainer):
-                    text += element.get_text()
+        if page_numbers is None:
+            with pymupdf.open(path) as doc:
+                page_numbers = range(doc.page_count)
 
-            texts.append(text)
+        if len(page_numbers) < PARALLEL_EXTRACT_MIN_PAGES or self.extract_workers < 2:
+            return _extract_pages_text(path, page_numbers, self.sort_text)
 
-        return texts
+        # Split pages in contiguous shards, one per worker process. A worker
+        # crashing on a malformed file breaks the pool, it is replaced so later
+        # files can still be extracted
+        shard_size = -(-len(page_numbers) // self.extract_workers)
+        pool = self.extract_pool
+        try:
+            futures = [
+                pool.submit(
+                    _extract_pages_text,
+                    path,
+                    page_numbers[start : start + shard_size],
+                    self.sort_text,
+                )
+                for start in range(0, len(page_numbers), shard_size)
+            ]
+            return [text for future in futures for text in future.result()]
+        except BrokenProcessPool:
+            self._replace_pool("extract_pool", pool)
+            raise
 
     def validate_pdf_mime_type(self, file_path: str) -> bool:
         """Check if the file is actually a PDF by MIME type
 
+        Files starting with the PDF header are accepted without running
+        libmagic, which reads a much larger part of the file.
+
         Args:
             file_path: Path to the file to check
 
         Returns:
             True if the file is a PDF, False otherwise
         """
-        mime = magic.from_file(file_path, mime=True)
+        with open(file_path, "rb") as file:
+            if file.read(len(PDF_HEADER)) == PDF_HEADER:
+                return True
+
+        mime = self.magic.from_file(str(file_path))
         return mime == "application/pdf"
 
     def get_pdf_page_count(self, pdf_path: str) -> int:
@@ -1,4 +1,7 @@
+import asyncio
+import base64
 import httpx
+import numpy as np
 import tiktoken
 from os import environ as env
 from itertools import islice
@@ -10,6 +13,14 @@ headers = {
 
 encoding = tiktoken.get_encoding("cl100k_base")
 
+# Amount of pages sent to the embedding API per request
+EMBED_BATCH = int(env.get("EMBED_BATCH", 64))
+# Seconds to wait for other inodes to fill up an embedding batch
+EMBED_WINDOW = float(env.get("EMBED_WINDOW", 0.05))
+
+# Keep connections to the embedding API alive between batches and calls
+client = httpx.Client(base_url="https://api.openai.com/v1", headers=headers, timeout=30)
+
 
 # Python 3.12 itertools provide this out of the box
 def batched(iterable, n):
@@ -18,8 +29,8 @@ def batched(iterable, n):
         yield batch
 
 
-def embed(strings):
-    for batch in batched(strings, 64):
+def embed(strings, batch_size=EMBED_BATCH):
+    for batch in batched(strings, batch_size):
         # Send tokens to external service instead of the whole text
         # https://community.openai.com/t/embedding-tokens-vs-embedding-strings
         data = {
@@ -31,15 +42,74 @@ def embed(strings):
                 encoding.encode(" ".join(string.split()))[:8192] for string in batch
             ],
             "model": "text-embedding-3-small",
+            # Base64 encoded float32 is about a quarter of the size of a JSON
+            # list of floats, and decodes without parsing every number
+            "encoding_format": "base64",
         }
-        response = httpx.post(
-            "https://api.openai.com/v1/embeddings",
-            headers=headers,
-            json=data,
-            timeout=30,
-        )
+        response = client.post("/embeddings", json=data)
         if response.status_code == 200:
             for embedding in response.json()["data"]:
-                yield embedding["embedding"]
+                yield np.frombuffer(
+                    base64.b64decode(embedding["embedding"]), dtype=np.float32
+                )
         else:
             raise Exception(response.text)
+
+
+# Coalesces the pages of inodes that are embedded concurrently, so small
+# documents share API requests instead of each sending a mostly empty batch
+class EmbedBatcher:
+    def __init__(self, batch_size=EMBED_BATCH, window=EMBED_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self.pending = []
+        self.pending_size = 0
+        self.timer = None
+        self.tasks = set()
+
+    # Embed strings, returns when the batch they ended up in is embedded
+    async def embed(self, strings):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((strings, future))
+        self.pending_size += len(strings)
+
+        if self.pending_size >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        pending, self.pending, self.pending_size = self.pending, [], 0
+        if pending:
+            # Keep a reference to the task, the event loop only holds weak ones
+            task = asyncio.create_task(self.embed_pending(pending))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def embed_pending(self, pending):
+        strings = [string for strings, _ in pending for string in strings]
+        try:
+            embeddings = await asyncio.to_thread(lambda: list(embed(strings)))
+        except Exception as e:
+            if len(pending) == 1:
+                _, future = pending[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # One inode's pages may have caused the failure, retry every inode on
+            # its own so the others in the batch still get their embeddings
+            await asyncio.gather(*(self.embed_pending([entry]) for entry in pending))
+            return
+
+        # Scatter the embeddings back to the inodes they were requested for
+        offset = 0
+        for strings, future in pending:
+            if not future.done():
+                future.set_result(embeddings[offset : offset + len(strings)])
+            offset += len(strings)
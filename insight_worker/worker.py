@@ -1,12 +1,15 @@
+import asyncio
+import csv
 import logging
 import json
 import ssl
 from os import environ as env
+from io import StringIO
+from itertools import chain
 from tempfile import TemporaryDirectory
 from pathlib import Path
-from pikepdf import PdfError
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy import select, func
+from sqlalchemy import select, func, update
 from sqlalchemy.orm import Session
 import aio_pika
 
@@ -14,13 +17,36 @@ from insight_worker.opensearch import OpenSearchService
 from insight_worker.minio import MinioService
 from insight_worker.pdf import PdfService
 from insight_worker.models import Pages, Inodes
-from insight_worker.rag import embed
+from insight_worker.rag import EMBED_BATCH, EmbedBatcher, batched
+
+# Amount of pages inserted per statement execution
+PAGES_BATCH = 200
 
 
 class IngestException(Exception):
     pass
 
 
+# Task messages survive broker restarts, losing one would stall the inode
+def persistent_message(body):
+    return aio_pika.Message(body=body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+
+
+# Body of the task messages that follow up on an inode
+def task_body(id):
+    return json.dumps({"after": {"id": id}}).encode()
+
+
+# Body of the notification telling users a task on an inode finished
+def notification_body(id, task):
+    return json.dumps({"id": id, "task": task}).encode()
+
+
+# Public inodes are announced to everyone, others only to their owner
+def notification_routing_key(inode):
+    return "public" if inode.is_public else f"user-{inode.owner_id}"
+
+
 class InsightWorker:
     def __init__(
         self,
@@ -35,8 +61,12 @@ class InsightWorker:
         self.pdf_service = pdf_service
         self.connection = None
         self.channel = None
+        self.notification_channel = None
+        self.embed_batcher = EmbedBatcher()
         self.insight_exchange = None
         self.user_exchange = None
+        # Files with more pages than this are loaded through COPY instead of INSERT
+        self.copy_threshold = int(env.get("PAGES_COPY_THRESHOLD", 200))
 
     # Generate a OCRd and optimized version of a uploaded PDF. The resulting PDF is
     # optimized for "fast web view", meaning it is linearized, allowing us to load
@@ -44,301 +74,592 @@ class InsightWorker:
     async def ingest_inode(self, id):
         logging.info(f"Ingesting inode {id}")
 
+        # Read the inode up front, no database connection is held while the file
+        # is downloaded and processed. Only the columns processing needs are read
+        inode = await asyncio.to_thread(self.load_ingest_inode, id)
+
+        to_page = inode.to_page
+        error = None
+        page_values = None
+        page_count = 0
+
         with TemporaryDirectory() as dir:
             temp_path = Path(dir)
             original_path = temp_path / "original"
+            optimized_path = temp_path / "optimized"
 
-            with Session(self.engine) as session:
-                stmt = select(Inodes).where(Inodes.id == id)
-                inode = session.scalars(stmt).one()
+            # An optimized file made from this exact upload already carries the OCR
+            # text layer, re-ingests read it instead of optimizing again
+            source_etag, optimized_source_etag = await asyncio.gather(
+                asyncio.to_thread(
+                    self.minio_service.get_etag, inode.owner_id, inode.path
+                ),
+                asyncio.to_thread(
+                    self.minio_service.get_optimized_source_etag,
+                    inode.owner_id,
+                    inode.path,
+                ),
+            )
+            reuse_optimized = optimized_source_etag == source_etag
 
-                self.minio_service.download_file(
+            if reuse_optimized:
+                await asyncio.to_thread(
+                    self.minio_service.download_optimized_file,
                     inode.owner_id,
                     inode.path,
-                    original_path,
+                    optimized_path,
+                )
+            else:
+                # Start the OCR worker while the file is downloading
+                await asyncio.gather(
+                    asyncio.to_thread(
+                        self.minio_service.download_file,
+                        inode.owner_id,
+                        inode.path,
+                        original_path,
+                        source_etag,
+                    ),
+                    asyncio.to_thread(self.pdf_service.warm_up),
                 )
 
-                try:
-                    # Is file actually PDF?
-                    if not self.pdf_service.validate_pdf_mime_type(original_path):
-                        raise IngestException("unsupported_file_type")
-
-                    repaired_path = temp_path / "repaired"
-                    optimized_path = temp_path / "optimized"
-
-                    # Store the length of the PDF
-                    if not inode.to_page:
-                        try:
-                            inode.to_page = self.pdf_service.get_pdf_page_count(
-                                original_path
-                            )
-                        except PdfError:
-                            raise IngestException("corrupted_file")
-
-                    try:
-                        # Repair and optimize the PDF
-                        self.pdf_service.repair_pdf(original_path, repaired_path)
-                        self.pdf_service.optimize_pdf(repaired_path, optimized_path)
-                    except Exception:
+            try:
+                input_path = optimized_path if reuse_optimized else original_path
+
+                # Is file actually PDF?
+                if not await asyncio.to_thread(
+                    self.pdf_service.validate_pdf_mime_type, input_path
+                ):
+                    raise IngestException("unsupported_file_type")
+
+                # Count pages and check the structure while the file is opened once
+                page_count, needs_repair = await asyncio.to_thread(
+                    self.pdf_service.inspect_pdf, input_path
+                )
+
+                # Store the length of the PDF
+                if not to_page:
+                    if page_count is None:
                         raise IngestException("corrupted_file")
+                    to_page = page_count
 
-                    # Upload the optimized file
-                    self.minio_service.upload_optimized_file(
-                        inode.owner_id,
-                        inode.path,
-                        optimized_path,
+                if reuse_optimized:
+                    page_texts = await asyncio.to_thread(
+                        self.pdf_service.extract_pdf_pages_text, optimized_path
+                    )
+                else:
+                    page_texts = await self.optimize_inode(
+                        inode, temp_path, needs_repair, source_etag
                     )
 
-                    # If this is a public inode, mark the optimized file also as a public file
-                    if inode.is_public:
-                        self.minio_service.set_public_tags(
-                            inode.owner_id, inode.path, inode.is_public
-                        )
-
-                    # Extract text from the optimized PDF
-                    page_texts = self.pdf_service.extract_pdf_pages_text(optimized_path)
-
-                    # Create list of page records
-                    page_values = [
-                        {
-                            "contents": text.replace("\x00", ""),
-                            "index": inode.from_page + index,
-                            "inode_id": inode.id,
-                        }
-                        for index, text in enumerate(page_texts)
-                    ]
-
-                    # Use PostgreSQL dialect insert with values and on_conflict_do_update
-                    stmt = insert(Pages).values(page_values)
-
-                    stmt = stmt.on_conflict_do_update(
-                        constraint="pages_inode_id_index_key",
-                        set_={
-                            "contents": stmt.excluded.contents,
-                        },
+                # Page records are generated as they are stored, so the text of
+                # every page isn't copied into a second list
+                from_page, inode_id = inode.from_page, inode.id
+                page_count = len(page_texts)
+                page_values = (
+                    {
+                        "contents": text.replace("\x00", ""),
+                        "index": from_page + index,
+                        "inode_id": inode_id,
+                    }
+                    for index, text in enumerate(page_texts)
+                )
+            except IngestException as e:
+                error = str(e)
+            except Exception as e:
+                logging.error(f"Error occurred during ingest of {id}", exc_info=e)
+
+        # Writing the pages of a large file takes a while, keep the event loop
+        # free for other messages
+        inode = await asyncio.to_thread(
+            self.store_ingest, id, page_values, page_count, error, to_page
+        )
+
+        if self.channel:
+            # After ingest, trigger index & embed
+            body = task_body(id)
+            messages = [
+                (
+                    self.insight_exchange,
+                    "embed_inode",
+                    persistent_message(body),
+                )
+            ]
+
+            # Notify user when this inode had meaningful status changes
+            if inode.is_ready or inode.error:
+                # Also notify user
+                notification = notification_body(id, "ingest_inode")
+                routing_key = notification_routing_key(inode)
+                messages.append(
+                    (
+                        self.user_exchange,
+                        routing_key,
+                        aio_pika.Message(body=notification),
                     )
+                )
 
-                    session.execute(stmt)
-                except IngestException as e:
-                    inode.error = str(e)
-                except Exception as e:
-                    logging.error(f"Error occurred during ingest of {id}", exc_info=e)
-                finally:
-                    inode.is_ingested = True
-                    session.commit()
-
-                    if self.channel:
-                        # After ingest, trigger index & embed
-                        body = json.dumps({"after": {"id": id}})
-                        await self.insight_exchange.publish(
-                            aio_pika.Message(
-                                body=body.encode(),
-                                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                            ),
-                            routing_key="embed_inode",
-                        )
-
-                        # Notify user when this inode had meaningful status changes
-                        if inode.is_ready or inode.error:
-                            # Also notify user
-                            notification = json.dumps(
-                                {"id": id, "task": "ingest_inode"}
-                            )
-                            routing_key = (
-                                "public"
-                                if inode.is_public
-                                else f"user-{inode.owner_id}"
-                            )
-                            await self.user_exchange.publish(
-                                aio_pika.Message(body=notification.encode()),
-                                routing_key=routing_key,
-                            )
+            await self.publish(messages)
+
+    # Store the results of an ingest in a fresh session, returns the inode.
+    # Attributes stay loaded after commit, the notifications read them without
+    # reloading the inode
+    def store_ingest(self, id, page_values, page_count, error, to_page):
+        with Session(self.engine, expire_on_commit=False) as session:
+            stmt = select(Inodes).where(Inodes.id == id)
+            inode = session.scalars(stmt).one()
+
+            if page_values:
+                self.store_pages(session, page_values, page_count)
+
+            if error:
+                inode.error = error
+            inode.to_page = to_page
+            inode.is_ingested = True
+            session.commit()
+            # is_ready is computed by the database, load it before the session
+            # closes so the notification can read it
+            inode.is_ready
+            return inode
+
+    # Load the columns of an inode that ingest needs
+    def load_ingest_inode(self, id):
+        with Session(self.engine) as session:
+            stmt = select(
+                Inodes.id,
+                Inodes.owner_id,
+                Inodes.path,
+                Inodes.from_page,
+                Inodes.to_page,
+                Inodes.is_public,
+            ).where(Inodes.id == id)
+            return session.execute(stmt).one()
+
+    # Repair, OCR and upload the optimized version of a downloaded file, returns
+    # the text of its pages
+    async def optimize_inode(self, inode, temp_path, needs_repair, source_etag):
+        original_path = temp_path / "original"
+        repaired_path = temp_path / "repaired"
+        optimized_path = temp_path / "optimized"
+
+        try:
+            # Only run the expensive repair when the PDF doesn't parse cleanly
+            source_path = original_path
+            linearized = False
+            if needs_repair:
+                linearized = await asyncio.to_thread(
+                    self.pdf_service.repair_pdf, original_path, repaired_path
+                )
+                source_path = repaired_path
+        except Exception:
+            raise IngestException("corrupted_file")
+
+        # Read the existing text layer, only pages without text need OCR
+        page_texts = await asyncio.to_thread(
+            self.pdf_service.extract_pdf_pages_text, source_path
+        )
+        ocr_pages = [index for index, text in enumerate(page_texts) if not text.strip()]
+
+        try:
+            if ocr_pages:
+                await asyncio.to_thread(
+                    self.pdf_service.optimize_pdf, source_path, optimized_path
+                )
+            elif linearized:
+                # The repair already wrote a linearized file
+                optimized_path = repaired_path
+            else:
+                # Without OCR the linearized file never has to hit the disk
+                optimized = await asyncio.to_thread(
+                    self.pdf_service.linearize_pdf, source_path
+                )
+        except Exception:
+            raise IngestException("corrupted_file")
+
+        # Upload the optimized file. After OCR, the text of the OCRd pages
+        # is read while the upload is in flight
+        ocr_texts = []
+        if linearized and not ocr_pages:
+            await asyncio.to_thread(
+                self.minio_service.upload_optimized_file,
+                inode.owner_id,
+                inode.path,
+                optimized_path,
+                source_etag,
+            )
+        elif ocr_pages:
+            _, ocr_texts = await asyncio.gather(
+                asyncio.to_thread(
+                    self.minio_service.upload_optimized_file,
+                    inode.owner_id,
+                    inode.path,
+                    optimized_path,
+                    source_etag,
+                ),
+                asyncio.to_thread(
+                    self.pdf_service.extract_pdf_pages_text,
+                    optimized_path,
+                    ocr_pages,
+                ),
+            )
+        else:
+            await asyncio.to_thread(
+                self.minio_service.upload_optimized_data,
+                inode.owner_id,
+                inode.path,
+                optimized,
+                optimized.getbuffer().nbytes,
+                source_etag,
+            )
+
+        # If this is a public inode, mark the optimized file also as a public file
+        if inode.is_public:
+            await asyncio.to_thread(
+                self.minio_service.set_public_tags,
+                inode.owner_id,
+                inode.path,
+                inode.is_public,
+            )
+
+        # Merge text of the OCRd pages into the existing text layer
+        for index, text in zip(ocr_pages, ocr_texts):
+            page_texts[index] = text
+
+        return page_texts
+
+    # Upsert page records, replacing the contents of pages that already exist
+    def store_pages(self, session, page_values, page_count):
+        if page_count > self.copy_threshold:
+            # COPY rows into a temporary table and upsert from there, COPY doesn't
+            # parse and plan every row like an INSERT does. Creating the table
+            # costs more than that saves on small files
+            buffer = StringIO()
+            writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerows(
+                (page["contents"], page["index"], page["inode_id"])
+                for page in page_values
+            )
+            buffer.seek(0)
+
+            dbapi_connection = session.connection().connection
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE TEMP TABLE pages_staging "
+                    "(contents text, index integer, inode_id bigint) ON COMMIT DROP"
+                )
+                cursor.copy_expert(
+                    "COPY pages_staging (contents, index, inode_id) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    buffer,
+                )
+                cursor.execute(
+                    "INSERT INTO pages (contents, index, inode_id) "
+                    "SELECT contents, index, inode_id FROM pages_staging "
+                    "ON CONFLICT ON CONSTRAINT pages_inode_id_index_key "
+                    "DO UPDATE SET contents = EXCLUDED.contents"
+                )
+            return
+
+        # Use PostgreSQL dialect insert with on_conflict_do_update. Passing the rows
+        # as parameters lets SQLAlchemy send them in batches of
+        # insertmanyvalues_page_size instead of compiling one statement with bound
+        # parameters for every page
+        stmt = insert(Pages)
+
+        stmt = stmt.on_conflict_do_update(
+            constraint="pages_inode_id_index_key",
+            set_={
+                "contents": stmt.excluded.contents,
+            },
+        )
+
+        # Execute per batch of pages to bound the parameters held at once
+        for batch in batched(page_values, PAGES_BATCH):
+            session.execute(stmt, list(batch))
 
     # Index inode into opensearch
     async def index_inode(self, id):
         logging.info(f"Indexing inode {id}")
-        with Session(self.engine) as session:
+        try:
+            # Bulk requests back off when OpenSearch is busy, that must not hold
+            # up the other messages on the event loop
+            inode = await asyncio.to_thread(self.index_documents, id)
+
+            if self.channel:
+                # Notify user when this inode had meaningful status changes
+                if inode.is_ready or inode.error:
+                    notification = notification_body(id, "index_inode")
+                    routing_key = notification_routing_key(inode)
+                    await self.user_exchange.publish(
+                        aio_pika.Message(body=notification),
+                        routing_key=routing_key,
+                    )
+        except Exception as e:
+            logging.error(f"Error indexing document {id}: {str(e)}", exc_info=e)
+            raise
+
+    # Send the inode and its pages to the index, returns the indexed inode
+    def index_documents(self, id):
+        with Session(self.engine, expire_on_commit=False) as session:
             stmt = select(Inodes).where(Inodes.id == id)
             inode = session.scalars(stmt).one()
             owner_id = inode.owner_id
+            # Convert once, every page document carries the owner
+            owner = str(owner_id)
+            # Only fetch the columns that end up in the index as plain rows
             stmt = (
-                select(Pages)
+                select(Pages.id, Pages.index, Pages.contents, Pages.embedding)
                 .where(func.length(Pages.contents) > 0)
                 .where(Pages.inode_id == inode.id)
             )
-            pages = session.scalars(stmt).all()
+            # Stream pages from a server side cursor, they are sent to the index
+            # while the rest is being fetched
+            pages = session.execute(
+                stmt.execution_options(stream_results=True, yield_per=PAGES_BATCH)
+            )
 
-            try:
-                # Index parent inode document
-                parent_document = {
-                    "id": inode.id,
-                    "path": f"{inode.path}",
-                    "type": inode.type,
-                    "folder": str(Path(inode.path).parent),
-                    "filename": inode.name,
-                    "owner_id": str(owner_id),
-                    "is_public": inode.is_public,
-                    "readable_by": [str(owner_id)],
-                    "join_field": {"name": "inode"},
-                }
-
-                # Index the parent inode first
-                self.opensearch_service.index_document(id, parent_document)
-
-                # Then index each page as a child document with proper routing
-                for page in pages:
+            # Index parent inode document
+            parent_document = {
+                "id": inode.id,
+                "path": f"{inode.path}",
+                "type": inode.type,
+                "folder": inode.path.rpartition("/")[0] or "/",
+                "filename": inode.name,
+                "owner_id": owner,
+                "is_public": inode.is_public,
+                "readable_by": [owner],
+                "join_field": {"name": "inode"},
+            }
+
+            # Index the parent inode first, then the pages as child documents
+            # with proper routing, in bulk requests instead of one per document
+            page_documents = (
+                (
                     # Create a unique ID for each page
-                    page_id = f"{id}_{page.index}"
-                    page_document = {
+                    f"{id}_{page.index}",
+                    {
                         "id": page.id,
-                        "owner_id": str(owner_id),
+                        "owner_id": owner,
                         "is_public": inode.is_public,
-                        "readable_by": [str(owner_id)],
+                        "readable_by": [owner],
                         "index": page.index - inode.from_page,
                         "contents": page.contents,
-                        "embedding": page.embedding.tolist(),
+                        "embedding": page.embedding,
                         "join_field": {"name": "page", "parent": id},
-                    }
-                    self.opensearch_service.index_document(page_id, page_document, id)
-
-                inode.is_indexed = True
-                session.commit()
-
-                if self.channel:
-                    # Notify user when this inode had meaningful status changes
-                    if inode.is_ready or inode.error:
-                        notification = json.dumps({"id": id, "task": "index_inode"})
-                        routing_key = (
-                            "public" if inode.is_public else f"user-{owner_id}"
-                        )
-                        await self.user_exchange.publish(
-                            aio_pika.Message(body=notification.encode()),
-                            routing_key=routing_key,
-                        )
-            except Exception as e:
-                logging.error(f"Error indexing document {id}: {str(e)}", exc_info=e)
-                raise
+                    },
+                    id,
+                )
+                for page in pages
+            )
+            self.opensearch_service.bulk_index(
+                chain([(id, parent_document, None)], page_documents)
+            )
+
+            inode.is_indexed = True
+            session.commit()
+            # is_ready is computed by the database, load it before the session
+            # closes so the notification can read it
+            inode.is_ready
+            return inode
 
     # Generate embeddings for inode pages
     async def embed_inode(self, id):
         logging.info(f"Embedding inode {id}")
+        inode = await asyncio.to_thread(self.load_embed_inode, id)
+
+        # Embed the pages per batch, so only one batch of pages and embeddings is
+        # held at a time. No database connection is held while the batcher waits
+        # for other inodes and the embedding API, concurrent messages would
+        # otherwise exhaust the connection pool
+        after_id = None
+        while pages := await asyncio.to_thread(
+            self.load_unembedded_pages, inode, after_id
+        ):
+            embeddings = await self.embed_batcher.embed(
+                [page.contents for page in pages]
+            )
+            await asyncio.to_thread(self.store_embeddings, pages, embeddings)
+            after_id = pages[-1].id
+
+        inode = await asyncio.to_thread(self.mark_embedded, id)
+
+        if self.channel:
+            body = task_body(id)
+            messages = [
+                (
+                    self.insight_exchange,
+                    "index_inode",
+                    persistent_message(body),
+                )
+            ]
+
+            # Notify user when this inode had meaningful status changes
+            if inode.is_ready or inode.error:
+                notification = notification_body(id, "embed_inode")
+                routing_key = notification_routing_key(inode)
+                messages.append(
+                    (
+                        self.user_exchange,
+                        routing_key,
+                        aio_pika.Message(body=notification),
+                    )
+                )
+
+            await self.publish(messages)
+
+    # Load the page range of an inode that is about to be embedded
+    def load_embed_inode(self, id):
         with Session(self.engine) as session:
-            stmt = select(Inodes).where(Inodes.id == id)
-            inode = session.scalars(stmt).one()
+            stmt = select(Inodes.id, Inodes.from_page, Inodes.to_page, Inodes.error)
+            inode = session.execute(stmt.where(Inodes.id == id)).one()
+
+        if inode.error is not None:
+            raise Exception("Cannot embed errored file")
+        return inode
+
+    # Next batch of pages without embedding, in order of ID
+    def load_unembedded_pages(self, inode, after_id):
+        stmt = (
+            select(Pages.id, Pages.contents)
+            .where(Pages.index >= inode.from_page)
+            .where(Pages.index < inode.to_page)
+            .where(Pages.embedding.is_(None))
+            .where(func.length(Pages.contents) > 0)
+            .where(Pages.inode_id == inode.id)
+            .order_by(Pages.id)
+            .limit(EMBED_BATCH)
+        )
+        if after_id is not None:
+            stmt = stmt.where(Pages.id > after_id)
 
-            if inode.error is not None:
-                raise Exception("Cannot embed errored file")
+        with Session(self.engine) as session:
+            return session.execute(stmt).all()
 
-            owner_id = inode.owner_id
-            stmt = (
-                select(Pages)
-                .where(Pages.index >= inode.from_page)
-                .where(Pages.index < inode.to_page)
-                .where(Pages.embedding == None)
-                .where(func.length(Pages.contents) > 0)
-                .where(Pages.inode_id == inode.id)
+    # Bulk UPDATE by primary key, executed as one executemany instead of flushing
+    # every page object separately
+    def store_embeddings(self, pages, embeddings):
+        with Session(self.engine) as session:
+            session.execute(
+                update(Pages),
+                [
+                    {"id": page.id, "embedding": embedding}
+                    for embedding, page in zip(embeddings, pages)
+                ],
             )
-            pages = session.scalars(stmt).all()
-            if pages:
-                embeddings = embed([page.contents for page in pages])
-                for embedding, page in zip(embeddings, pages):
-                    page.embedding = embedding
+            session.commit()
 
+    # Flag the inode as embedded once all of its pages are
+    def mark_embedded(self, id):
+        with Session(self.engine, expire_on_commit=False) as session:
+            stmt = select(Inodes).where(Inodes.id == id)
+            inode = session.scalars(stmt).one()
             inode.is_embedded = True
             session.commit()
-
-            if self.channel:
-                body = json.dumps({"after": {"id": id}})
-                await self.insight_exchange.publish(
-                    aio_pika.Message(
-                        body=body.encode(),
-                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                    ),
-                    routing_key="index_inode",
-                )
-
-                # Notify user when this inode had meaningful status changes
-                if inode.is_ready or inode.error:
-                    notification = json.dumps({"id": id, "task": "embed_inode"})
-                    routing_key = "public" if inode.is_public else f"user-{owner_id}"
-                    await self.user_exchange.publish(
-                        aio_pika.Message(body=notification.encode()),
-                        routing_key=routing_key,
-                    )
+            # is_ready is computed by the database, load it before the session
+            # closes so the notification can read it
+            inode.is_ready
+            return inode
 
     # Move file in object storage
     async def move_inode(self, id):
         logging.info(f"Moving inode {id}")
 
-        with Session(self.engine) as session:
-            stmt = select(Inodes).where(Inodes.id == id)
-            inode = session.scalars(stmt).one()
-            stmt = select(func.inode_path(Inodes.id)).where(Inodes.id == inode.id)
-            path = session.scalars(stmt).first()
+        # Storage requests block, run them off the event loop
+        moved = await asyncio.to_thread(self.move_files, id)
+
+        # After update, re-index
+        if moved and self.channel:
+            body = task_body(id)
+            await self.insight_exchange.publish(
+                persistent_message(body),
+                routing_key="index_inode",
+            )
+
+    # Move the objects of an inode to its new path, returns whether it moved
+    def move_files(self, id):
+        with Session(self.engine, expire_on_commit=False) as session:
+            # Load the inode and compute its new path in a single round-trip
+            stmt = select(Inodes, func.inode_path(Inodes.id)).where(Inodes.id == id)
+            inode, path = session.execute(stmt).one()
 
             # If paths didn't change, we don't have to update the storage backend
-            if path != inode.path:
-                # Move in storage backend if this is a file
-                if inode.type == "file":
-                    # Move file in storage
-                    self.minio_service.move_file(inode.owner_id, inode.path, path)
-
-                # Move succesful, save new path (object paths are inferred from path)
-                inode.path = path
-                inode.should_move = False
-                session.commit()
-
-                # After update, re-index
-                if self.channel:
-                    body = json.dumps({"after": {"id": id}})
-                    await self.insight_exchange.publish(
-                        aio_pika.Message(
-                            body=body.encode(),
-                            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                        ),
-                        routing_key="index_inode",
-                    )
+            if path == inode.path:
+                return False
+
+            # Move in storage backend if this is a file
+            if inode.type == "file":
+                # Move file in storage
+                self.minio_service.move_file(inode.owner_id, inode.path, path)
+
+            # Move succesful, save new path (object paths are inferred from path)
+            inode.path = path
+            inode.should_move = False
+            session.commit()
+            return True
 
     # Make file accessible for non-owners on inode share
     async def share_inode(self, id):
         logging.info(f"Sharing inode {id}")
 
-        with Session(self.engine) as session:
-            stmt = select(Inodes).where(Inodes.id == id)
-            inode = session.scalars(stmt).one()
+        inode = await asyncio.to_thread(self.load_share_inode, id)
 
-            # For public files we use object tags to allow users access
-            if inode.type == "file":
-                self.minio_service.set_public_tags(
-                    inode.owner_id, inode.path, inode.is_public
-                )
+        # For public files we use object tags to allow users access
+        if inode.type == "file":
+            await asyncio.to_thread(
+                self.minio_service.set_public_tags,
+                inode.owner_id,
+                inode.path,
+                inode.is_public,
+            )
 
         if self.channel:
             # Re-index this inode to change share status in opensearch to
-            body = json.dumps({"after": {"id": id}})
+            body = task_body(id)
             await self.insight_exchange.publish(
-                aio_pika.Message(
-                    body=body.encode(), delivery_mode=aio_pika.DeliveryMode.PERSISTENT
-                ),
+                persistent_message(body),
                 routing_key="index_inode",
             )
 
+    # Load the columns of an inode that sharing needs
+    def load_share_inode(self, id):
+        with Session(self.engine) as session:
+            stmt = select(Inodes.type, Inodes.owner_id, Inodes.path, Inodes.is_public)
+            return session.execute(stmt.where(Inodes.id == id)).one()
+
     # Remove files from object storage on inode deletion
     async def delete_inode(self, data):
         logging.info(f"Deleting inode {data['id']}")
 
-        # Make sure all original and optimized files are destroyed
-        if data["type"] == "file":
-            errors = self.minio_service.delete_file(data["owner_id"], data["path"])
-            for error in errors:
-                logging.error(f"error occurred when deleting object", error)
+        # Storage and index are independent, remove from both concurrently
+        async def delete_files():
+            # Make sure all original and optimized files are destroyed
+            if data["type"] == "file":
+                errors = await asyncio.to_thread(
+                    self.minio_service.delete_file, data["owner_id"], data["path"]
+                )
+                for error in errors:
+                    logging.error("error occurred when deleting object: %s", error)
 
-        # Remove indexed contents of files that descend this inode
-        try:
-            self.opensearch_service.delete_document(data["id"])
-        except Exception as e:
-            # Record could be not found for whatever reason
-            logging.error(f"Error deleting document {data['id']}: {str(e)}")
+        async def delete_document():
+            # Remove indexed contents of files that descend this inode
+            try:
+                await asyncio.to_thread(
+                    self.opensearch_service.delete_document, data["id"]
+                )
+            except Exception as e:
+                # Record could be not found for whatever reason
+                logging.error(f"Error deleting document {data['id']}: {str(e)}")
+
+        await asyncio.gather(delete_files(), delete_document())
+
+    # Publish (exchange, routing_key, message) tuples back-to-back so the
+    # broker confirms are awaited together instead of one round-trip each
+    async def publish(self, messages):
+        await asyncio.gather(
+            *(
+                exchange.publish(message, routing_key=routing_key)
+                for exchange, routing_key, message in messages
+            )
+        )
 
     async def setup_rabbitmq(self):
         # Configure SSL if enabled
@@ -357,13 +678,20 @@ class InsightWorker:
 
         # Create channel
         self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=1)
+        # Messages processed concurrently. Ingest takes minutes and should stay at
+        # one, queues with short tasks benefit from a higher prefetch
+        await self.channel.set_qos(prefetch_count=int(env.get("RABBITMQ_PREFETCH", 1)))
 
         # Declare exchanges
         self.insight_exchange = await self.channel.declare_exchange(
             "insight", aio_pika.ExchangeType.DIRECT, durable=True
         )
-        self.user_exchange = await self.channel.declare_exchange(
+        # User notifications are transient, losing one is harmless. Publish them on
+        # a channel without publisher confirms so they don't wait on the broker
+        self.notification_channel = await self.connection.channel(
+            publisher_confirms=False
+        )
+        self.user_exchange = await self.notification_channel.declare_exchange(
             "user", aio_pika.ExchangeType.TOPIC, durable=True
         )
 